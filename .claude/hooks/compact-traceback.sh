@@ -4,6 +4,8 @@
 
 set -euo pipefail
 
+TB_HEADER="Traceback (most recent call last):"
+
 # Read hook input JSON from stdin
 INPUT=$(cat)
 
@@ -21,6 +23,14 @@ if [ "$HOOK_EVENT" = "UserPromptSubmit" ]; then
         exit 0
     fi
 
+    # Skip starting Python at all when there is no traceback header. A bash pattern
+    # match, not `echo | grep -q`: grep exits on the first hit, echo then dies of SIGPIPE
+    # on large inputs and pipefail would turn the hit into a miss.
+    if [[ "$TEXT" != *"$TB_HEADER"* ]]; then
+        echo "{}"
+        exit 0
+    fi
+
     # Compact tracebacks in the prompt
     COMPACTED=$(echo "$TEXT" | claude-trace-compactor --stdin --project-root "${CLAUDE_PROJECT_DIR:-.}" 2>/dev/null || echo "$TEXT")
 
@@ -41,15 +51,30 @@ elif [ "$HOOK_EVENT" = "PostToolUse" ]; then
     STDOUT=$(echo "$INPUT" | jq -r '.tool_response.stdout // ""')
     STDERR=$(echo "$INPUT" | jq -r '.tool_response.stderr // ""')
 
+    # Only run the compactor on streams that contain a traceback header
+    STDOUT_HAS_TB=false
+    STDERR_HAS_TB=false
+    if [[ "$STDOUT" == *"$TB_HEADER"* ]]; then
+        STDOUT_HAS_TB=true
+    fi
+    if [[ "$STDERR" == *"$TB_HEADER"* ]]; then
+        STDERR_HAS_TB=true
+    fi
+
+    if [ "$STDOUT_HAS_TB" = "false" ] && [ "$STDERR_HAS_TB" = "false" ]; then
+        echo "{}"
+        exit 0
+    fi
+
     # Compact tracebacks in both
-    COMPACTED_STDOUT=""
-    COMPACTED_STDERR=""
+    COMPACTED_STDOUT="$STDOUT"
+    COMPACTED_STDERR="$STDERR"
 
-    if [ -n "$STDOUT" ]; then
+    if [ "$STDOUT_HAS_TB" = "true" ]; then
         COMPACTED_STDOUT=$(echo "$STDOUT" | claude-trace-compactor --stdin --project-root "${CLAUDE_PROJECT_DIR:-.}" 2>/dev/null || echo "$STDOUT")
     fi
 
-    if [ -n "$STDERR" ]; then
+    if [ "$STDERR_HAS_TB" = "true" ]; then
         COMPACTED_STDERR=$(echo "$STDERR" | claude-trace-compactor --stdin --project-root "${CLAUDE_PROJECT_DIR:-.}" 2>/dev/null || echo "$STDERR")
     fi
 
@@ -6,6 +6,7 @@ from ctools.trace_compactor import (
     rewrite_prompt_for_claude,
     compact_traceback_block,
     parse_traceback_text,
+    extract_fingerprint,
 )
 
 __version__ = "0.1.0"
@@ -14,4 +15,5 @@ __all__ = [
     "rewrite_prompt_for_claude",
     "compact_traceback_block",
     "parse_traceback_text",
+    "extract_fingerprint",
 ]
@@ -32,242 +32,574 @@ import re
 import os
 import sys
 import json
+import time
+import atexit
 import hashlib
 import argparse
-from typing import Optional, List, Dict, Any, Tuple
+import threading
+import functools
+import collections
+from typing import Optional, List, Dict, Any, Callable, Iterator, Tuple
 
 __all__ = [
     "rewrite_prompt_for_claude",
     "compact_traceback_block",
     "parse_traceback_text",
+    "extract_fingerprint",
 ]
 
 # ---------------------------------------------------------------------------
 # Regexes / constants
 # ---------------------------------------------------------------------------
-TRACEBACK_BLOCK_RE = re.compile(
-    r"("  # capture the whole block
-    r"Traceback\s*\(most\s+recent\s+call\s+last\):"  # header
-    r"(?:\r?\n)"
-    r"(?:[ \t]+File\s+\".*?\",\s+line\s+\d+,\s+in\s+.*(?:\r?\n)"
-    r"(?:[ \t]+.*(?:\r?\n))?"  # optional code line after each frame
-    r")+"
-    r'[^"]+?(?:Error|Exception|Warning|RuntimeError|AssertionError|TypeError|ValueError)[:]?.*?'
-    r")",
-    re.VERBOSE | re.MULTILINE,
-)
+# exception class name; Interrupt/Exit cover KeyboardInterrupt, SystemExit, GeneratorExit
+_EXC_NAME = r"[A-Za-z_][\w.]*(?:Error|Exception|Warning|Interrupt|Exit)"
+
+# exception line that terminates a traceback block (anchored, tried once per candidate line)
+BLOCK_END_RE = re.compile(_EXC_NAME + r"(?::|\s*$)")
+
+FRAME_RE = re.compile(r'^\s*File "(.+?)", line (\d+), in (.+)$')
+LINE_RE = re.compile(r"[^\n]*\n?")
+CODE_RE = re.compile(r'^\s+(\S.*)$')  # no nested .* so whitespace-only lines fail in O(n)
+EXC_LINE_RE = re.compile(r"^(" + _EXC_NAME + r")(?::\s*(.*)|\s*$)")
+# fallback for hand-edited tags; anchored to the tag so prose mentioning fingerprint= is ignored
+FINGERPRINT_RE = re.compile(r"<COMPACT_PY_TRACEBACK\b[^>]*?fingerprint=(\w+)")
 
-FRAME_RE = re.compile(r'File "(.+?)", line (\d+), in (.+)')
-CODE_RE = re.compile(r'^\s+(.*\S.*)$')
-EXC_LINE_RE = re.compile(r'([\w\.]+(?:Error|Exception|Warning|RuntimeError|AssertionError|TypeError|ValueError)):\s*(.*)')
+# literal traceback header, used as a cheap substring prefilter and block start marker
+TRACEBACK_HEADER = "Traceback (most recent call last):"
 
 # compact block wrapper template
 COMPACT_OPEN = "<COMPACT_PY_TRACEBACK fingerprint={fp}>"
 COMPACT_CLOSE = "</COMPACT_PY_TRACEBACK>"
+_COMPACT_OPEN_HEAD, _COMPACT_OPEN_TAIL = COMPACT_OPEN.split("{fp}")
+# start of an opening tag, whatever its attributes
+_COMPACT_MARKER = "<COMPACT_PY_TRACEBACK"
+
+# LRU cache of compacted blocks: (block digest, max_frames, root, cwd) -> (text, stats)
+_COMPACT_CACHE_SIZE = 256
+_COMPACT_CACHE: collections.OrderedDict = collections.OrderedDict()
+_COMPACT_CACHE_LOCK = threading.Lock()
+
+# path fragments marking stdlib, site-packages and virtualenv files
+_STDLIB_TOKENS = ("site-packages", "/lib/python", "/.venv/", "/venv/")
+# relative virtualenv paths, which the "/venv/" tokens above can't see
+_VENV_PREFIXES = ("venv/", ".venv/")
+
+# ---------------------------------------------------------------------------
+# Opt-in regex profiling (CTOOLS_TB_PROFILE=1)
+# ---------------------------------------------------------------------------
+
+class _ProfiledPattern:
+    """Wrap a compiled regex and record calls, matches and time spent in match/search.
+
+    Anything else (``finditer``, ``pattern``...) is delegated to the wrapped pattern
+    unprofiled.
+    """
+
+    __slots__ = ("name", "regex", "calls", "matches", "ns")
+
+    def __init__(self, name: str, regex: re.Pattern[str]) -> None:
+        self.name = name
+        self.regex = regex
+        self.calls = 0
+        self.matches = 0
+        self.ns = 0
+
+    def _timed(self, method: Any, *args: Any) -> Any:
+        t0 = time.perf_counter_ns()
+        m = method(*args)
+        self.ns += time.perf_counter_ns() - t0
+        self.calls += 1
+        if m is not None:
+            self.matches += 1
+        return m
+
+    def match(self, *args: Any) -> Any:
+        return self._timed(self.regex.match, *args)
+
+    def search(self, *args: Any) -> Any:
+        return self._timed(self.regex.search, *args)
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.regex, attr)
+
+
+_PROFILED: List[_ProfiledPattern] = []
+
+
+def _dump_profile() -> None:
+    """Print one line per profiled regex to stderr, most expensive first."""
+    for p in sorted(_PROFILED, key=lambda p: p.ns, reverse=True):
+        print(
+            f"[ctools profile] {p.name}: calls={p.calls} matches={p.matches} "
+            f"time={p.ns / 1e6:.3f}ms",
+            file=sys.stderr,
+        )
+
+
+if os.environ.get("CTOOLS_TB_PROFILE") == "1":
+    BLOCK_END_RE = _ProfiledPattern("BLOCK_END_RE", BLOCK_END_RE)
+    FRAME_RE = _ProfiledPattern("FRAME_RE", FRAME_RE)
+    CODE_RE = _ProfiledPattern("CODE_RE", CODE_RE)
+    EXC_LINE_RE = _ProfiledPattern("EXC_LINE_RE", EXC_LINE_RE)
+    FINGERPRINT_RE = _ProfiledPattern("FINGERPRINT_RE", FINGERPRINT_RE)
+    _PROFILED.extend([BLOCK_END_RE, FRAME_RE, CODE_RE, EXC_LINE_RE, FINGERPRINT_RE])
+    atexit.register(_dump_profile)
 
 # ---------------------------------------------------------------------------
 # Parsing logic
 # ---------------------------------------------------------------------------
 
-def parse_traceback_text(text: str) -> Dict[str, Any]:
-    """Parse a pasted traceback text into frames and exception lines.
+# one parsed traceback frame, as used internally by compaction and scoring
+_Frame = collections.namedtuple(
+    "_Frame", "filename lineno name code_line raw_index basename", defaults=("",)
+)
 
-    Returns a dict with keys:
-      - frames: list of {filename, lineno, name, code_line, raw_index}
-      - exception_lines: list of exception strings found (in order of appearance)
-      - raw_lines: the original split lines
 
-    The parser is conservative and skips malformed lines.
+def _frame_dict(
+    filename: str, lineno: int, name: str, code_line: str, raw_index: int, basename: str
+) -> Dict[str, Any]:
+    """Build the public frame dict returned by `parse_traceback_text`."""
+    return {
+        "filename": filename,
+        "lineno": lineno,
+        "name": name,
+        "code_line": code_line,
+        "raw_index": raw_index,
+        "basename": basename,
+    }
+
+
+def _fast_parse_frame(line: str) -> Optional[Tuple[str, str, str]]:
+    """Split a canonical `File "...", line N, in name` line with plain string searches.
+
+    Returns the same ``(filename, lineno, name)`` groups as FRAME_RE, or None when the
+    line is not in canonical form, in which case the caller falls back to the regex.
     """
-    lines = text.splitlines()
-    frames: List[Dict[str, Any]] = []
-    exception_lines: List[str] = []
+    start = line.find('File "')
+    if start < 0 or (start and not line[:start].isspace()):
+        return None
+    fn_start = start + 6
+    fn_end = line.find('", line ', fn_start + 1)
+    if fn_end < 0:
+        return None
+    ln_start = fn_end + 8
+    ln_end = line.find(", in ", ln_start)
+    if ln_end < 0:
+        return None
+    lineno_s = line[ln_start:ln_end]
+    name = line[ln_end + 5:]
+    if not lineno_s.isdecimal() or not name:
+        return None
+    return line[fn_start:fn_end], lineno_s, name
+
+
+def _iter_frames(
+    text: str, exception_lines: List[str], make: Callable[..., Any] = _Frame
+) -> Iterator[Any]:
+    """Yield the frames of a pasted traceback text one at a time.
+
+    Each frame is built with ``make(filename, lineno, name, code_line, raw_index,
+    basename)``: a `_Frame` by default, or a dict for `parse_traceback_text`. Exception
+    lines are appended to `exception_lines` as they are found; the list is complete once
+    the generator is exhausted. The parser is conservative and skips
+    malformed lines. It streams over `text` in a single pass instead of materializing a
+    list of lines, so consumers can reduce frames without holding them all.
+    """
+    # (filename, lineno, name, raw_index, basename) of a frame still waiting for its code line
+    pending: Optional[Tuple[str, int, str, int, str]] = None
+    collected: Optional[str] = None  # exception line still collecting continuations
+
+    for i, m in enumerate(LINE_RE.finditer(text)):
+        ln = m.group()
+        if not ln:
+            # trailing empty match at end of text
+            break
+        ln = ln.rstrip("\r\n")
 
-    i = 0
-    while i < len(lines):
-        ln = lines[i]
-        m = FRAME_RE.search(ln)
-        if m:
-            filename, lineno_s, func = m.groups()
+        if collected is not None:
+            # collect continuations that are indented or blank
+            if ln[:4] == "    ":
+                collected += " " + ln.strip()
+                continue
+            if not ln or ln.isspace():
+                collected += " "
+                continue
+            exception_lines.append(collected)
+            collected = None
+
+        if pending is not None:
+            mcode = CODE_RE.match(ln)
+            code_line = mcode.group(1).strip() if mcode else ""
+            yield make(pending[0], pending[1], pending[2], code_line, pending[3], pending[4])
+            pending = None
+
+        # frame lines: slice canonical ones, FRAME_RE for the rest
+        groups = None
+        if 'File "' in ln:
+            groups = _fast_parse_frame(ln)
+            if groups is None:
+                mf = FRAME_RE.match(ln)
+                if mf:
+                    groups = mf.groups()
+        if groups is not None:
+            filename, lineno_s, func = groups
             try:
                 lineno = int(lineno_s)
             except Exception:
                 lineno = -1
 
-            code_line = ""
-            if i + 1 < len(lines):
-                mcode = CODE_RE.match(lines[i + 1])
-                if mcode:
-                    code_line = mcode.group(1).strip()
-
-            frames.append({
-                "filename": filename,
-                "lineno": lineno,
-                "name": func.strip(),
-                "code_line": code_line,
-                "raw_index": i,
-            })
-            i += 1
+            pending = (filename, lineno, func.strip(), i, filename.rpartition("/")[2] or filename)
             continue
 
-        m2 = EXC_LINE_RE.search(ln.strip())
-        if m2:
-            # collect continuations that are indented or blank
-            collected = ln.strip()
-            j = i + 1
-            while j < len(lines) and (lines[j].startswith("    ") or lines[j].strip() == ""):
-                collected += " " + lines[j].strip()
-                j += 1
-            exception_lines.append(collected)
-            i = j
-            continue
+        # exception lines: prefilter on the suffixes of _EXC_NAME
+        if (
+            "Error" in ln
+            or "Exception" in ln
+            or "Warning" in ln
+            or "Interrupt" in ln
+            or "Exit" in ln
+        ):
+            stripped = ln.strip()
+            if EXC_LINE_RE.match(stripped):
+                collected = stripped
+
+    if collected is not None:
+        exception_lines.append(collected)
+    if pending is not None:
+        yield make(pending[0], pending[1], pending[2], "", pending[3], pending[4])
+
+
+def parse_traceback_text(text: str) -> Dict[str, Any]:
+    """Parse a pasted traceback text into frames and exception lines.
 
-        i += 1
+    Returns a dict with keys:
+      - frames: list of dicts with keys filename, lineno, name, code_line, raw_index and
+        basename
+      - exception_lines: list of exception strings found (in order of appearance)
 
-    return {"frames": frames, "exception_lines": exception_lines, "raw_lines": lines}
+    The parser is conservative and skips malformed lines.
+    """
+    exception_lines: List[str] = []
+    frames = list(_iter_frames(text, exception_lines, _frame_dict))
+    return {"frames": frames, "exception_lines": exception_lines}
 
 
 # ---------------------------------------------------------------------------
 # Compaction logic
 # ---------------------------------------------------------------------------
 
+@functools.lru_cache(maxsize=256)
 def _is_stdlib_path(path: str) -> bool:
     """Lightweight heuristic to detect stdlib/site-packages paths.
 
-    It's intentionally conservative and only used as a heuristic for scoring.
+    It's intentionally conservative and only used as a heuristic for scoring. Tokens are
+    matched against the raw path, so no path normalization is needed.
     """
     if not path:
         return False
-    try:
-        p = os.path.abspath(path)
-    except Exception:
-        return False
+    return (
+        path.endswith(".egg")
+        or path.startswith(_VENV_PREFIXES)
+        or any(t in path for t in _STDLIB_TOKENS)
+    )
 
-    if sys_prefix := getattr(os, "sys", None):
-        # defensive: avoid importing sys at module scope for some embed scenarios
-        pass
 
-    if "site-packages" in p or "/lib/python" in p or p.endswith(".egg"):
-        return True
-    # also mark virtualenvs under .venv
-    if ".venv" in p or "venv" in p:
-        return True
-    return False
-
-
-def _frame_score(f: Dict[str, Any], project_root: Optional[str] = None) -> int:
+def _frame_score(f: _Frame, project_root: Optional[str] = None) -> int:
     """Score frames to choose the most relevant ones for compacting.
 
-    Higher score means more relevant.
+    Higher score means more relevant. `project_root` is compared as a plain prefix and is
+    expected to be normalized already (absolute, ending with a separator so that sibling
+    directories such as ``/proj-old`` don't match ``/proj``); `compact_traceback_block`
+    does this once per block.
     """
-    fname = f.get("filename") or ""
-    score = 0
-    try:
-        if project_root and fname and os.path.abspath(fname).startswith(os.path.abspath(project_root)):
-            score += 100
-    except Exception:
-        pass
+    fname = f.filename or ""
+    in_project = (
+        os.path.abspath(fname).startswith(project_root) if project_root and fname else False
+    )
+    # project +100, non-stdlib +10, later frames higher
+    return 100 * in_project + 10 * (not _is_stdlib_path(fname)) + f.raw_index
 
-    if not _is_stdlib_path(fname):
-        score += 10
 
-    # favor later frames (closer to error) - higher raw_index = more recent in traceback
-    score += int(f.get("raw_index", 0))
-    return score
+@functools.lru_cache(maxsize=1024)
+def _fingerprint_key(filename: str, lineno: int, name: str) -> bytes:
+    """Return the UTF-8 fingerprint payload of one frame.
 
+    Cached so a frame seen again (in another block, or the same traceback with a new
+    message) is not formatted and encoded again.
+    """
+    return f"{filename}\0{lineno}\0{name}\0".encode("utf-8", "surrogatepass")
 
-def compact_traceback_block(block: str, *, max_frames: int = 4, project_root: Optional[str] = None) -> str:
-    """Compact a single traceback block (string) into a short tagged summary.
 
-    This function intentionally avoids filesystem access and locals capture so it is
-    suitable to run in a fast in-flight hook.
-    """
-    parsed = parse_traceback_text(block)
-    frames = parsed["frames"]
-    exception_lines = parsed["exception_lines"]
+def _compact_block(
+    block: str, max_frames: int, norm_root: Optional[str]
+) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """Compact `block` and return ``(text, stats)``; `stats` is None if nothing was compacted.
 
-    if not frames:
+    Depends only on its arguments and, when `norm_root` is set, on the current directory
+    (relative frame filenames are resolved against it), so the cache key holds both.
+    `norm_root` must already be normalized as described in `_frame_score`.
+    """
+    exception_lines: List[str] = []
+    # dedupe recursive frames, keeping the latest copy in traceback order
+    latest: Dict[Tuple[str, int, str], _Frame] = {}
+    nframes = 0
+    for f in _iter_frames(block, exception_lines):
+        key = (f.filename, f.lineno, f.name)
+        if key in latest:
+            del latest[key]
+        latest[key] = f
+        nframes += 1
+
+    if not nframes:
         # Not a recognized traceback; return original block
-        return block
+        return block, None
 
-    # pick candidate frames by score
-    scored = sorted(frames, key=lambda f: _frame_score(f, project_root=project_root), reverse=True)
-    chosen: List[Dict[str, Any]] = []
-    chosen_keys = set()
-    for f in scored:
-        key = (f.get("filename"), f.get("lineno"), f.get("name"))
-        if key in chosen_keys:
-            continue
-        chosen.append(f)
-        chosen_keys.add(key)
-        if len(chosen) >= max_frames:
-            break
-
-    # preserve original ordering (earliest->latest)
-    chosen_set = set(id(f) for f in chosen)
-    ordered = [f for f in frames if id(f) in chosen_set]
+    unique = list(latest.values())
+    if len(unique) <= max_frames:
+        # every distinct frame fits: no scoring needed, already in traceback order
+        ordered = unique
+    else:
+        # pick candidate frames by score
+        scores = [_frame_score(f, norm_root) for f in unique]
+        top = sorted(range(len(unique)), key=scores.__getitem__, reverse=True)[:max_frames]
+        # preserve original ordering (earliest->latest)
+        top.sort()
+        ordered = [unique[i] for i in top]
 
     # build fingerprint (short)
-    fp_src = json.dumps([{"f": (f.get("filename"), f.get("lineno"), f.get("name"))} for f in ordered], sort_keys=True)
-    fingerprint = hashlib.sha1(fp_src.encode("utf-8")).hexdigest()[:10]
+    payload = b"".join([_fingerprint_key(f.filename, f.lineno, f.name) for f in ordered])
+    fingerprint = hashlib.blake2b(payload, digest_size=5).hexdigest()
 
     # build compact text
     primary_exc = exception_lines[-1] if exception_lines else "<unknown exception>"
 
-    lines = [COMPACT_OPEN.format(fp=fingerprint), f"Exception: {primary_exc}", "", "Relevant frames:"]
+    frame_lines: List[str] = []
     for f in ordered:
-        fn = f.get("filename") or "<unknown>"
-        base = fn.rsplit("/", 1)[-1]
-        ln = f.get("lineno")
-        name = f.get("name") or "<unknown>"
-        code = f.get("code_line") or ""
+        base = f.basename or f.filename or "<unknown>"
+        name = f.name or "<unknown>"
+        code = f.code_line
         if code:
-            lines.append(f"- {base}:{ln} in {name} → {code}")
+            frame_lines.append(f"- {base}:{f.lineno} in {name} → {code}")
         else:
-            lines.append(f"- {base}:{ln} in {name}")
+            frame_lines.append(f"- {base}:{f.lineno} in {name}")
+    frames_text = "\n".join(frame_lines)
+
+    compact = (
+        f"{_COMPACT_OPEN_HEAD}{fingerprint}{_COMPACT_OPEN_TAIL}\n"
+        f"Exception: {primary_exc}\n\nRelevant frames:\n"
+        f"{frames_text}\n"
+        f"{COMPACT_CLOSE}"
+    )
+    return compact, {"frames_found": nframes, "fingerprint": fingerprint}
+
+
+def compact_traceback_block(
+    block: str,
+    *,
+    max_frames: int = 4,
+    project_root: Optional[str] = None,
+    collect: Optional[List[Dict[str, Any]]] = None,
+) -> str:
+    """Compact a single traceback block (string) into a short tagged summary.
 
-    lines.append(COMPACT_CLOSE)
-    return "\n".join(lines)
+    This function intentionally avoids filesystem access and locals capture so it is
+    suitable to run in a fast in-flight hook.
+
+    If `collect` is given, a ``{"frames_found": n, "fingerprint": fp}`` entry is appended
+    to it for the compacted block, so callers get parse statistics without re-parsing.
+
+    Results are memoized (LRU, `_COMPACT_CACHE_SIZE` entries): the same traceback pasted
+    again across conversation turns is a dict lookup instead of a full parse. Entries are
+    keyed on a digest of the block, so the cache never holds on to large inputs.
+    """
+    # no frame line at all: nothing to parse, and no need to touch the cache
+    if 'File "' not in block:
+        return block
+
+    # normalize the project root (absolute, trailing separator)
+    norm_root = os.path.join(os.path.abspath(project_root), "") if project_root else None
+    # a compact block always lists at least one frame (the CLI accepts any int)
+    max_frames = max(max_frames, 1)
+    key = (
+        hashlib.blake2b(block.encode("utf-8", "surrogatepass"), digest_size=16).digest(),
+        max_frames,
+        norm_root,
+        # relative frame filenames are resolved against the cwd for the project check
+        os.getcwd() if norm_root else None,
+    )
+    # lock the cache bookkeeping only; compaction runs unlocked
+    with _COMPACT_CACHE_LOCK:
+        cached = _COMPACT_CACHE.get(key)
+        if cached is not None:
+            _COMPACT_CACHE.move_to_end(key)
+    if cached is None:
+        cached = _compact_block(block, max_frames, norm_root)
+        with _COMPACT_CACHE_LOCK:
+            _COMPACT_CACHE[key] = cached
+            if len(_COMPACT_CACHE) > _COMPACT_CACHE_SIZE:
+                _COMPACT_CACHE.popitem(last=False)
+
+    compacted, stats = cached
+    if collect is not None and stats is not None:
+        collect.append(dict(stats))
+    return compacted
+
+
+def extract_fingerprint(compacted: str) -> Optional[str]:
+    """Return the fingerprint of the first compact block in `compacted`, or None.
+
+    The opening tag is emitted by this module, so the fingerprint is normally sliced out
+    between ``fingerprint=`` and ``>`` with two `str.find` calls; FINGERPRINT_RE only runs
+    when the tag is not in that exact form.
+    """
+    i = compacted.find(_COMPACT_OPEN_HEAD)
+    if i >= 0:
+        i += len(_COMPACT_OPEN_HEAD)
+        j = compacted.find(_COMPACT_OPEN_TAIL, i)
+        if j > i and compacted[i:j].isalnum():
+            return compacted[i:j]
+    m = FINGERPRINT_RE.search(compacted)
+    return m.group(1) if m else None
 
 
 # ---------------------------------------------------------------------------
 # Prompt rewrite hook
 # ---------------------------------------------------------------------------
 
-def rewrite_prompt_for_claude(prompt: str, *, max_frames: int = 4, project_root: Optional[str] = None) -> str:
+def _is_frame_line(line: str) -> bool:
+    """Return True for an indented `File "..."` traceback frame line."""
+    return line[:1] in (" ", "\t") and line.lstrip(" \t").startswith('File "')
+
+
+def _iter_traceback_spans(prompt: str) -> Iterator[Tuple[int, int]]:
+    """Yield ``(start, end)`` offsets of the traceback blocks found in `prompt`.
+
+    Linear scanner: header, then one or more `File "..."` frames (each followed by
+    optional indented code lines), then an exception line. No backtracking involved.
+    A block starts at the header and ends with the exception line, newline excluded.
+
+    The scanner jumps from header to header with `str.find`, so prose between tracebacks
+    is skipped in C; only the lines following a header are looked at one by one.
+    """
+    pos = 0
+    while True:
+        start = prompt.find(TRACEBACK_HEADER, pos)
+        if start < 0:
+            return
+        pos = start + len(TRACEBACK_HEADER)
+
+        # walk the lines after the header line; cur == 0 means there is no next line
+        cur = prompt.find("\n", pos) + 1
+        nframes = 0
+        line = ""
+        while cur:
+            nl = prompt.find("\n", cur)
+            line = prompt[cur:] if nl < 0 else prompt[cur:nl + 1]
+            if _is_frame_line(line):
+                nframes += 1
+            elif not (nframes and line[:1] in (" ", "\t")):
+                # neither a frame nor a code line belonging to one
+                break
+            cur = nl + 1
+
+        if cur and nframes and BLOCK_END_RE.match(line):
+            yield start, cur + len(line.rstrip("\r\n"))
+            pos = cur + len(line)
+        elif not cur:
+            # the walk ran to the end of the prompt: any later header would too
+            return
+        else:
+            # header without a well-formed traceback body; leave it alone and resume
+            # at the line the walk stopped on
+            pos = cur
+
+
+def _compact_raw_segment(
+    segment: str,
+    max_frames: int,
+    project_root: Optional[str],
+    collect: Optional[List[Dict[str, Any]]],
+) -> str:
+    """Replace every traceback block in `segment` (text with no compact block) in place."""
+    if TRACEBACK_HEADER not in segment:
+        return segment
+
+    parts: List[str] = []
+    prev_end = 0
+    for start, end in _iter_traceback_spans(segment):
+        block = segment[start:end]
+        try:
+            compacted = compact_traceback_block(
+                block, max_frames=max_frames, project_root=project_root, collect=collect
+            )
+        except Exception:
+            # on failure, keep the original block to avoid data loss
+            compacted = block
+        parts.append(segment[prev_end:start])
+        parts.append(compacted)
+        prev_end = end
+
+    parts.append(segment[prev_end:])
+    return "".join(parts)
+
+
+def rewrite_prompt_for_claude(
+    prompt: str,
+    *,
+    max_frames: int = 4,
+    project_root: Optional[str] = None,
+    collect: Optional[List[Dict[str, Any]]] = None,
+) -> str:
     """Detect traceback blocks in `prompt` and replace them with compact summaries.
 
     Safe to call on arbitrary text. Deterministic and idempotent: already-compact blocks
-    (those starting with <COMPACT_PY_TRACEBACK) are left untouched.
+    (``<COMPACT_PY_TRACEBACK ...>`` up to ``</COMPACT_PY_TRACEBACK>``) are copied through
+    untouched, and only the raw text between them is scanned for tracebacks.
+
+    `collect` is passed through to `compact_traceback_block` for every block found.
     """
-    # do not re-process already compacted blocks
-    if "<COMPACT_PY_TRACEBACK" in prompt:
+    # cheap substring check first
+    if TRACEBACK_HEADER not in prompt:
         return prompt
 
-    def _repl(m: re.Match) -> str:
-        block = m.group(1)
-        try:
-            return compact_traceback_block(block, max_frames=max_frames, project_root=project_root)
-        except Exception:
-            # on failure, return original block to avoid data loss
-            return block
+    if _COMPACT_MARKER not in prompt:
+        return _compact_raw_segment(prompt, max_frames, project_root, collect)
 
-    return TRACEBACK_BLOCK_RE.sub(_repl, prompt)
+    # partition the prompt into raw and compact segments
+    parts: List[str] = []
+    pos = 0
+    while True:
+        start = prompt.find(_COMPACT_MARKER, pos)
+        if start < 0:
+            break
+        parts.append(_compact_raw_segment(prompt[pos:start], max_frames, project_root, collect))
+        end = prompt.find(COMPACT_CLOSE, start)
+        if end < 0:
+            # unterminated compact block: leave the rest of the prompt alone
+            parts.append(prompt[start:])
+            return "".join(parts)
+        pos = end + len(COMPACT_CLOSE)
+        parts.append(prompt[start:pos])
+
+    parts.append(_compact_raw_segment(prompt[pos:], max_frames, project_root, collect))
+    return "".join(parts)
 
 
 # ---------------------------------------------------------------------------
 # CLI for testing
 # ---------------------------------------------------------------------------
 
-def _cli_main(argv: Optional[List[str]] = None) -> int:
-    parser = argparse.ArgumentParser(prog="claude_trace_compactor")
-    parser.add_argument("--stdin", action="store_true", help="read prompt from stdin")
-    parser.add_argument("--file", type=str, help="read prompt from file")
-    parser.add_argument("--project-root", type=str, default=None, help="path to bias towards user code")
-    parser.add_argument("--max-frames", type=int, default=4)
-    parser.add_argument("--json", action="store_true", help="output JSON with structured fields")
+# argument parser, built once
+_CLI_PARSER = argparse.ArgumentParser(prog="claude_trace_compactor")
+_CLI_PARSER.add_argument("--stdin", action="store_true", help="read prompt from stdin")
+_CLI_PARSER.add_argument("--file", type=str, help="read prompt from file")
+_CLI_PARSER.add_argument("--project-root", type=str, default=None, help="path to bias towards user code")
+_CLI_PARSER.add_argument("--max-frames", type=int, default=4)
+_CLI_PARSER.add_argument("--json", action="store_true", help="output JSON with structured fields")
 
-    ns = parser.parse_args(argv)
+
+def _cli_main(argv: Optional[List[str]] = None) -> int:
+    ns = _CLI_PARSER.parse_args(argv)
 
     if ns.stdin:
         text = sys.stdin.read()
@@ -275,17 +607,19 @@ def _cli_main(argv: Optional[List[str]] = None) -> int:
         with open(ns.file, "r", encoding="utf-8") as fh:
             text = fh.read()
     else:
-        parser.error("either --stdin or --file is required")
+        _CLI_PARSER.error("either --stdin or --file is required")
 
-    compacted = rewrite_prompt_for_claude(text, max_frames=ns.max_frames, project_root=ns.project_root)
+    stats: List[Dict[str, Any]] = []
+    compacted = rewrite_prompt_for_claude(
+        text, max_frames=ns.max_frames, project_root=ns.project_root, collect=stats
+    )
 
     if ns.json:
-        # return a small structured payload: replace compact blocks with JSON entries
-        parsed = parse_traceback_text(compacted)
+        # return a small structured payload; frame counts come from the compaction pass
         out = {
             "original_preview": text[:400],
             "compacted_preview": compacted[:400],
-            "frames_found": len(parsed.get("frames", [])),
+            "frames_found": sum(st["frames_found"] for st in stats),
         }
         print(json.dumps(out, indent=2))
     else:
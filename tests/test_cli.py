@@ -103,6 +103,23 @@ ZeroDivisionError: division by zero"""
                 except json.JSONDecodeError:
                     self.fail("Output is not valid JSON")
 
+    def test_cli_json_frames_found(self):
+        """Test that JSON output counts frames of the original tracebacks"""
+        test_input = """Traceback (most recent call last):
+  File "a.py", line 1, in <module>
+    f()
+  File "b.py", line 2, in f
+    x = 1/0
+ZeroDivisionError: division by zero"""
+
+        with patch('sys.stdin', io.StringIO(test_input)):
+            with patch('sys.stdout', new_callable=io.StringIO) as mock_stdout:
+                exit_code = _cli_main(['--stdin', '--json'])
+
+                self.assertEqual(exit_code, 0)
+                data = json.loads(mock_stdout.getvalue())
+                self.assertEqual(data['frames_found'], 2)
+
     def test_cli_file_input(self):
         """Test CLI with file input"""
         test_content = """Traceback (most recent call last):
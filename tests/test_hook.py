@@ -0,0 +1,89 @@
+"""
+Tests for the .claude/hooks/compact-traceback.sh hook script
+"""
+
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HOOK = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    ".claude",
+    "hooks",
+    "compact-traceback.sh",
+)
+
+TRACEBACK = """Traceback (most recent call last):
+  File "app.py", line 3, in run
+    go()
+ValueError: boom"""
+
+
+@unittest.skipUnless(shutil.which("bash") and shutil.which("jq"), "hook needs bash and jq")
+class TestHookScript(unittest.TestCase):
+    """Run the hook script end to end"""
+
+    def setUp(self):
+        # put a `claude-trace-compactor` that runs this checkout first on PATH
+        self.bindir = tempfile.mkdtemp()
+        wrapper = os.path.join(self.bindir, "claude-trace-compactor")
+        with open(wrapper, "w") as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" -m ctools.trace_compactor "$@"\n')
+        os.chmod(wrapper, os.stat(wrapper).st_mode | stat.S_IEXEC)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.env = dict(
+            os.environ,
+            PATH=self.bindir + os.pathsep + os.environ.get("PATH", ""),
+            PYTHONPATH=root,
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.bindir)
+
+    def run_hook(self, payload):
+        proc = subprocess.run(
+            ["bash", HOOK],
+            input=json.dumps(payload),
+            capture_output=True,
+            text=True,
+            env=self.env,
+            check=True,
+        )
+        return json.loads(proc.stdout)
+
+    def test_prompt_without_traceback_passes_through(self):
+        """Test that a prompt with no traceback answers {}"""
+        self.assertEqual(self.run_hook({"prompt": "just a question"}), {})
+
+    def test_large_prompt_is_compacted(self):
+        """Test that a prompt larger than the pipe buffer (~64KB) is still compacted"""
+        prompt = TRACEBACK + "\n" + "filler line of prose\n" * 5000
+
+        result = self.run_hook({"prompt": prompt})
+
+        self.assertIn("<COMPACT_PY_TRACEBACK", result["updatedPrompt"])
+
+    def test_large_bash_output_is_compacted(self):
+        """Test that large Bash tool output with a traceback is compacted"""
+        stderr = TRACEBACK + "\n" + "log line\n" * 10000
+
+        result = self.run_hook(
+            {
+                "hook_event_name": "PostToolUse",
+                "tool_name": "Bash",
+                "tool_response": {"stdout": "ok", "stderr": stderr},
+            }
+        )
+
+        response = result["hookSpecificOutput"]["updatedResponse"]
+        self.assertIn("<COMPACT_PY_TRACEBACK", response["stderr"])
+        self.assertEqual(response["stdout"], "ok")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,6 +8,7 @@ from ctools.trace_compactor import (
     parse_traceback_text,
     compact_traceback_block,
     rewrite_prompt_for_claude,
+    extract_fingerprint,
 )
 
 
@@ -27,6 +28,7 @@ ZeroDivisionError: division by zero"""
 
         self.assertEqual(len(parsed["frames"]), 2)
         self.assertEqual(parsed["frames"][0]["filename"], "/home/user/test.py")
+        self.assertEqual(parsed["frames"][0]["basename"], "test.py")
         self.assertEqual(parsed["frames"][0]["lineno"], 10)
         self.assertEqual(parsed["frames"][0]["name"], "main")
         self.assertEqual(parsed["frames"][1]["lineno"], 5)
@@ -62,6 +64,39 @@ KeyError: 'key'"""
         self.assertEqual(len(parsed["exception_lines"]), 1)
         self.assertIn("KeyError", parsed["exception_lines"][0])
 
+    def test_parse_frames_are_plain_dicts(self):
+        """Test that parsed frames are JSON-serializable dicts"""
+        parsed = parse_traceback_text("""Traceback (most recent call last):
+  File "test.py", line 3, in main
+    run()
+ValueError: bad""")
+
+        frame = parsed["frames"][0]
+        self.assertIn("filename", frame)
+        self.assertEqual(dict(frame)["code_line"], "run()")
+        self.assertEqual(json.loads(json.dumps(parsed))["frames"][0]["lineno"], 3)
+
+    def test_parse_bare_exception_name(self):
+        """Test parsing an exception line without a message"""
+        parsed = parse_traceback_text("""Traceback (most recent call last):
+  File "loop.py", line 7, in <module>
+    time.sleep(1)
+KeyboardInterrupt""")
+
+        self.assertEqual(parsed["exception_lines"], ["KeyboardInterrupt"])
+
+    def test_parse_non_canonical_frame_line(self):
+        """Test that frame lines the fast path can't split still parse via FRAME_RE"""
+        parsed = parse_traceback_text(
+            'Traceback (most recent call last):\n'
+            '  File "odd", line x.py", line 3, in f\n'
+            'ValueError: bad'
+        )
+
+        self.assertEqual(len(parsed["frames"]), 1)
+        self.assertEqual(parsed["frames"][0]["filename"], 'odd", line x.py')
+        self.assertEqual(parsed["frames"][0]["lineno"], 3)
+
     def test_parse_empty_text(self):
         """Test parsing empty text"""
         parsed = parse_traceback_text("")
@@ -155,6 +190,154 @@ KeyError: 'missing'"""
         # Site-packages frames should be deprioritized
         self.assertNotIn("click/core.py", compacted)
 
+    def test_compact_dedupes_recursive_frames(self):
+        """Test that repeated frames (recursion) are listed once, keeping the latest copy"""
+        recursion = """  File "a.py", line 1, in f
+    g()
+  File "b.py", line 2, in g
+    f()
+""" * 3
+        traceback = f"""Traceback (most recent call last):
+{recursion}  File "c.py", line 3, in h
+    raise RecursionError("deep")
+RecursionError: deep"""
+
+        stats = []
+        compacted = compact_traceback_block(traceback, max_frames=4, collect=stats)
+
+        self.assertEqual(stats[0]["frames_found"], 7)
+        frame_lines = [ln for ln in compacted.splitlines() if ln.startswith("- ")]
+        self.assertEqual(
+            frame_lines,
+            [
+                "- a.py:1 in f → g()",
+                "- b.py:2 in g → f()",
+                '- c.py:3 in h → raise RecursionError("deep")',
+            ],
+        )
+
+    def test_compact_non_positive_max_frames(self):
+        """Test that max_frames below 1 still lists the most relevant frame"""
+        traceback = """Traceback (most recent call last):
+  File "a.py", line 1, in f
+    g()
+  File "b.py", line 2, in g
+    raise ValueError("x")
+ValueError: x"""
+
+        for max_frames in (0, -1, -3):
+            compacted = compact_traceback_block(traceback, max_frames=max_frames)
+            frame_lines = [ln for ln in compacted.splitlines() if ln.startswith("- ")]
+            self.assertEqual(frame_lines, ['- b.py:2 in g → raise ValueError("x")'])
+
+    def test_compact_collects_stats(self):
+        """Test that compaction statistics are appended to `collect`"""
+        traceback = """Traceback (most recent call last):
+  File "a.py", line 1, in f
+    g()
+  File "b.py", line 2, in g
+    raise ValueError("x")
+ValueError: x"""
+
+        stats = []
+        compacted = compact_traceback_block(traceback, collect=stats)
+
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]["frames_found"], 2)
+        self.assertIn(f"fingerprint={stats[0]['fingerprint']}>", compacted)
+
+    def test_compact_repeated_block_is_cached(self):
+        """Test that compacting the same block twice hits the cache"""
+        from unittest.mock import patch
+
+        traceback = """Traceback (most recent call last):
+  File "cached.py", line 3, in run
+    run()
+RecursionError: maximum recursion depth exceeded"""
+
+        first = compact_traceback_block(traceback)
+        with patch("ctools.trace_compactor._compact_block", side_effect=AssertionError):
+            second = compact_traceback_block(traceback)
+
+        self.assertEqual(first, second)
+
+    def test_compact_cache_tracks_current_directory(self):
+        """Test that relative frames are re-scored after a chdir instead of reusing the cache"""
+        import os
+        import tempfile
+
+        traceback = """Traceback (most recent call last):
+  File "main.py", line 1, in main
+    helper()
+  File "/usr/x.py", line 2, in helper
+    raise ValueError("x")
+ValueError: x"""
+        project = tempfile.mkdtemp()
+        elsewhere = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.chdir(project)
+            inside = compact_traceback_block(traceback, project_root=project, max_frames=1)
+            os.chdir(elsewhere)
+            outside = compact_traceback_block(traceback, project_root=project, max_frames=1)
+        finally:
+            os.chdir(cwd)
+            os.rmdir(project)
+            os.rmdir(elsewhere)
+
+        self.assertIn("main.py:1", inside)
+        self.assertIn("x.py:2", outside)
+
+    def test_compact_cache_is_thread_safe(self):
+        """Test that concurrent callers sharing a small cache don't raise"""
+        import sys
+        import threading
+        from unittest.mock import patch
+
+        blocks = [
+            f"Traceback (most recent call last):\n  File \"t{i}.py\", line 1, in f\nValueError: {i}"
+            for i in range(6)
+        ]
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(100):
+                    for block in blocks:
+                        compact_traceback_block(block)
+            except Exception as exc:  # pragma: no cover - only reached on a race
+                errors.append(exc)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # switch threads as often as possible
+        try:
+            with patch("ctools.trace_compactor._COMPACT_CACHE_SIZE", 2):
+                threads = [threading.Thread(target=worker) for _ in range(8)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+        finally:
+            sys.setswitchinterval(interval)
+
+        self.assertEqual(errors, [])
+
+    def test_compact_sibling_directory_not_project(self):
+        """Test that a directory sharing the project root's prefix is not a project frame"""
+        traceback = """Traceback (most recent call last):
+  File "/home/user/myproject/main.py", line 3, in main
+    helper()
+  File "/home/user/myproject-old/helper.py", line 8, in helper
+    raise ValueError("x")
+ValueError: x"""
+
+        compacted = compact_traceback_block(
+            traceback, project_root="/home/user/myproject", max_frames=1
+        )
+
+        self.assertIn("main.py", compacted)
+        self.assertNotIn("helper.py", compacted)
+
 
 class TestRewritePrompt(unittest.TestCase):
     """Test prompt rewriting functionality"""
@@ -227,6 +410,62 @@ Relevant frames:
         # Should be unchanged (idempotent)
         self.assertEqual(rewritten, prompt)
 
+    def test_rewrite_mixed_compacted_and_raw(self):
+        """Test that a raw traceback next to a compacted block is still compacted"""
+        compact = """<COMPACT_PY_TRACEBACK fingerprint=abc123>
+Exception: ValueError: test
+Relevant frames:
+- test.py:1 in main
+</COMPACT_PY_TRACEBACK>"""
+        prompt = f"""Earlier:
+{compact}
+And now:
+Traceback (most recent call last):
+  File "app.py", line 3, in run
+    go()
+KeyError: 'x'"""
+
+        rewritten = rewrite_prompt_for_claude(prompt)
+
+        self.assertIn(compact, rewritten)
+        self.assertNotIn("Traceback (most recent call last):", rewritten)
+        self.assertEqual(rewritten.count("<COMPACT_PY_TRACEBACK"), 2)
+        self.assertEqual(rewrite_prompt_for_claude(rewritten), rewritten)
+
+    def test_rewrite_consumes_full_exception_line(self):
+        """Test that the exception message ends up inside the compact block"""
+        prompt = """Error:
+Traceback (most recent call last):
+  File "test.py", line 5, in main
+    result = process()
+ZeroDivisionError: division by zero
+What now?"""
+
+        rewritten = rewrite_prompt_for_claude(prompt)
+
+        self.assertIn("Exception: ZeroDivisionError: division by zero", rewritten)
+        self.assertTrue(rewritten.endswith("</COMPACT_PY_TRACEBACK>\nWhat now?"))
+
+    def test_rewrite_system_exit(self):
+        """Test that tracebacks ending in SystemExit are compacted"""
+        prompt = """Traceback (most recent call last):
+  File "cli.py", line 3, in <module>
+    sys.exit(2)
+SystemExit: 2"""
+
+        rewritten = rewrite_prompt_for_claude(prompt)
+
+        self.assertIn("<COMPACT_PY_TRACEBACK", rewritten)
+        self.assertIn("Exception: SystemExit: 2", rewritten)
+
+    def test_rewrite_header_without_frames_unchanged(self):
+        """Test that a bare traceback header without frames is left alone"""
+        prompt = "Traceback (most recent call last):\nno frames here\nValueError: nope"
+
+        rewritten = rewrite_prompt_for_claude(prompt)
+
+        self.assertEqual(rewritten, prompt)
+
     def test_rewrite_with_project_root(self):
         """Test rewriting with project root for better frame scoring"""
         prompt = """Error:
@@ -254,21 +493,23 @@ class TestFrameScoring(unittest.TestCase):
 
     def test_project_frames_score_higher(self):
         """Test that frames in project root score highest"""
-        from ctools.trace_compactor import _frame_score
-
-        project_frame = {
-            "filename": "/home/user/myproject/main.py",
-            "lineno": 10,
-            "name": "main",
-            "raw_index": 2
-        }
-
-        external_frame = {
-            "filename": "/usr/lib/python3.11/os.py",
-            "lineno": 100,
-            "name": "getcwd",
-            "raw_index": 1
-        }
+        from ctools.trace_compactor import _Frame, _frame_score
+
+        project_frame = _Frame(
+            filename="/home/user/myproject/main.py",
+            lineno=10,
+            name="main",
+            code_line="",
+            raw_index=2,
+        )
+
+        external_frame = _Frame(
+            filename="/usr/lib/python3.11/os.py",
+            lineno=100,
+            name="getcwd",
+            code_line="",
+            raw_index=1,
+        )
 
         project_score = _frame_score(project_frame, project_root="/home/user/myproject")
         external_score = _frame_score(external_frame, project_root="/home/user/myproject")
@@ -278,21 +519,23 @@ class TestFrameScoring(unittest.TestCase):
 
     def test_recent_frames_score_higher(self):
         """Test that more recent frames (lower index) score higher"""
-        from ctools.trace_compactor import _frame_score
-
-        early_frame = {
-            "filename": "/home/test.py",
-            "lineno": 1,
-            "name": "early",
-            "raw_index": 0
-        }
-
-        late_frame = {
-            "filename": "/home/test.py",
-            "lineno": 10,
-            "name": "late",
-            "raw_index": 5
-        }
+        from ctools.trace_compactor import _Frame, _frame_score
+
+        early_frame = _Frame(
+            filename="/home/test.py",
+            lineno=1,
+            name="early",
+            code_line="",
+            raw_index=0,
+        )
+
+        late_frame = _Frame(
+            filename="/home/test.py",
+            lineno=10,
+            name="late",
+            code_line="",
+            raw_index=5,
+        )
 
         early_score = _frame_score(early_frame)
         late_score = _frame_score(late_frame)
@@ -300,6 +543,39 @@ class TestFrameScoring(unittest.TestCase):
         # Later frames (closer to error) should score higher
         self.assertGreater(late_score, early_score)
 
+    def test_library_path_tokens(self):
+        """Test which paths count as library (stdlib, site-packages, virtualenv) code"""
+        from ctools.trace_compactor import _is_stdlib_path
+
+        for path in (
+            "/usr/lib/python3.11/json/decoder.py",
+            "/home/u/p/.venv/lib/python3.11/site-packages/click/core.py",
+            "/home/u/p/venv/bin/tool.py",
+            "/home/u/p/.venv/src/pkg.py",
+            "venv/src/pkg.py",
+            ".venv/src/pkg.py",
+            "/opt/eggs/thing.egg",
+        ):
+            self.assertTrue(_is_stdlib_path(path), path)
+
+        for path in (
+            "/home/u/p/main.py",
+            "/home/u/myvenv_tools/main.py",
+            "/home/u/convenvience/main.py",
+            "src/venv_utils.py",
+            "",
+        ):
+            self.assertFalse(_is_stdlib_path(path), path)
+
+    def test_relative_venv_frame_scores_as_library(self):
+        """Test that a relative virtualenv path loses the user-code bonus"""
+        from ctools.trace_compactor import _Frame, _frame_score
+
+        venv_frame = _Frame("venv/src/x.py", 1, "f", "", 0)
+        user_frame = _Frame("app/main.py", 1, "f", "", 0)
+
+        self.assertEqual(_frame_score(user_frame) - _frame_score(venv_frame), 10)
+
 
 class TestEdgeCases(unittest.TestCase):
     """Test edge cases and error handling"""
@@ -328,6 +604,35 @@ ValueError: Error with 'quotes' and "escapes\""""
         self.assertIn("<COMPACT_PY_TRACEBACK", result)
         self.assertIn("ValueError", result)
 
+    def test_whitespace_only_line_after_frame(self):
+        """Test that a huge whitespace-only line after a frame parses quickly"""
+        traceback = (
+            "Traceback (most recent call last):\n"
+            '  File "test.py", line 1, in <module>\n'
+            + " " * 50000
+            + "\nValueError: boom"
+        )
+
+        parsed = parse_traceback_text(traceback)
+
+        self.assertEqual(len(parsed["frames"]), 1)
+        self.assertEqual(parsed["frames"][0]["code_line"], "")
+
+    def test_many_unterminated_headers_scan_linearly(self):
+        """Test that headers inside an unterminated block don't re-walk the same lines"""
+        import time
+
+        body = '  File "x.py", line 1, in f\n  Traceback (most recent call last):\n' * 4000
+        prompt = "Traceback (most recent call last):\n" + body
+
+        t0 = time.perf_counter()
+        rewritten = rewrite_prompt_for_claude(prompt)
+        elapsed = time.perf_counter() - t0
+
+        self.assertEqual(rewritten, prompt)
+        # quadratic re-walking took ~20s on this 260KB input; linear is milliseconds
+        self.assertLess(elapsed, 2.0)
+
     def test_very_long_traceback(self):
         """Test handling of very long tracebacks"""
         # Create a traceback with many frames
@@ -358,6 +663,18 @@ ValueError: Erreur: ñoño"""
         self.assertIn("<COMPACT_PY_TRACEBACK", result)
         self.assertIn("ValueError", result)
 
+    def test_lone_surrogate_in_filename(self):
+        """Test that undecodable filename bytes (surrogateescape) still compact"""
+        traceback = """Traceback (most recent call last):
+  File "/srv/caf\udce9.py", line 1, in main
+    run()
+ValueError: bad"""
+
+        result = compact_traceback_block(traceback)
+
+        self.assertIn("<COMPACT_PY_TRACEBACK", result)
+        self.assertIn("caf\udce9.py:1 in main", result)
+
 
 class TestFingerprinting(unittest.TestCase):
     """Test deterministic fingerprinting"""
@@ -405,6 +722,47 @@ KeyError: test"""
         self.assertIsNotNone(fp_match2)
         self.assertNotEqual(fp_match1.group(1), fp_match2.group(1))
 
+    def test_extract_fingerprint(self):
+        """Test extracting the fingerprint from compacted output"""
+        traceback = """Traceback (most recent call last):
+  File "test.py", line 5, in main
+    raise ValueError("test")
+ValueError: test"""
+        stats = []
+
+        result = compact_traceback_block(traceback, collect=stats)
+
+        self.assertEqual(extract_fingerprint(f"See:\n{result}"), stats[0]["fingerprint"])
+
+    def test_extract_fingerprint_malformed_tag(self):
+        """Test fingerprint extraction from a tag not in the emitted form"""
+        self.assertEqual(
+            extract_fingerprint("<COMPACT_PY_TRACEBACK  fingerprint=abc123 >"), "abc123"
+        )
+        self.assertIsNone(extract_fingerprint("no compact block here"))
+        self.assertIsNone(extract_fingerprint("set fingerprint=foo in the config"))
+
+
+class TestProfiledPattern(unittest.TestCase):
+    """Test the opt-in regex profiling wrapper"""
+
+    def test_counts_calls_and_matches(self):
+        """Test that match/search calls and hits are counted and other methods delegate"""
+        import re
+
+        from ctools.trace_compactor import _ProfiledPattern
+
+        pattern = _ProfiledPattern("TEST_RE", re.compile(r"\d+"))
+
+        self.assertIsNotNone(pattern.match("12 apples"))
+        self.assertIsNone(pattern.match("apples"))
+        self.assertEqual(pattern.search("apples 3").group(), "3")
+        self.assertEqual([m.group() for m in pattern.finditer("1 2")], ["1", "2"])
+
+        self.assertEqual(pattern.calls, 3)
+        self.assertEqual(pattern.matches, 2)
+        self.assertGreaterEqual(pattern.ns, 0)
+
 
 if __name__ == "__main__":
     unittest.main()